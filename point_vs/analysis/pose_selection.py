@@ -1,7 +1,11 @@
 """Gather stats on pose selection performance on a validation set."""
 
 import argparse
-from collections import defaultdict
+import mmap
+import multiprocessing as mp
+import os
+import pickle
+import tempfile
 from pathlib import Path
 
 import numpy as np
@@ -10,7 +14,163 @@ import yaml
 from matplotlib import pyplot as plt
 
 from point_vs.analysis.ranking import Ranking
-from point_vs.utils import load_yaml
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+
+def load_rmsd_info(rmsd_info_fname):
+    """Load RMSD info from yaml, using a pickled copy where it is up to date.
+
+    Parsing large yaml files is slow, so a pickle of the loaded dict is saved
+    alongside the yaml file (as <rmsd_info_fname>.pkl) and used in preference
+    to the yaml file for as long as it is newer. If the pickle cannot be read,
+    the yaml file is parsed (and the pickle rewritten) instead. The yaml file
+    is parsed with the same (full) loader as point_vs.utils.load_yaml, using
+    libyaml where it is available.
+
+    Arguments:
+        rmsd_info_fname: file containing yaml dict which maps from pdbids to
+            dicts which map from indices to RMSD values
+
+    Returns:
+        Dictionary containing the RMSD info.
+    """
+    yaml_path = Path(rmsd_info_fname).expanduser()
+    cache_path = yaml_path.with_name(yaml_path.name + '.pkl')
+    if cache_path.is_file() and \
+            cache_path.stat().st_mtime >= yaml_path.stat().st_mtime:
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError, IndexError, TypeError, ValueError):
+            # A corrupt or stale cache is never fatal; fall back to the yaml
+            pass
+    with open(yaml_path, 'r') as f:
+        rmsd_info = yaml.load(f, Loader=Loader)
+
+    # Write to a temporary file and move it into place, so that an
+    # interrupted or concurrent run never leaves a truncated cache behind
+    tmp_fname = None
+    try:
+        with tempfile.NamedTemporaryFile(
+                'wb', dir=cache_path.parent, prefix=cache_path.name,
+                suffix='.tmp', delete=False) as f:
+            tmp_fname = f.name
+            pickle.dump(rmsd_info, f)
+        os.replace(tmp_fname, cache_path)
+    except OSError:
+        if tmp_fname is not None and os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+    return rmsd_info
+
+
+def flatten_rmsd_info(rmsd_info):
+    """Map each pdbid to an array of docked RMSDs indexed by pose number.
+
+    Arguments:
+        rmsd_info: dicts which map from pdbids to dicts which map from indices
+            to RMSD values
+
+    Returns:
+        Dictionary mapping pdbids to float arrays, where entry i holds the
+        RMSD of docked pose i with respect to the crystal pose (NaN where
+        there is no RMSD recorded for pose i).
+    """
+    rmsd_lookup = {}
+    for pdbid, record in rmsd_info.items():
+        rmsds = record['docked_wrt_crystal']
+        indices = np.fromiter(rmsds.keys(), dtype=np.int64)
+        rmsd_arr = np.full(indices.max() + 1 if len(indices) else 0, np.nan)
+        rmsd_arr[indices] = np.fromiter(rmsds.values(), dtype=np.float64)
+        rmsd_lookup[pdbid] = rmsd_arr
+    return rmsd_lookup
+
+
+def file_stems(paths):
+    """Strip the directories and all extensions from a Series of paths."""
+    return paths.str.rsplit('/', n=1).str[-1].str.split('.', n=1).str[0]
+
+
+def find_docked_sdfs(root):
+    """Recursively yield the paths of all docked_poses.sdf files under root.
+
+    os.scandir is used so that the file type of each directory entry is read
+    from the directory listing itself, rather than with an extra stat call per
+    entry as with Path.glob. As with Path.glob, directories which cannot be
+    read are skipped.
+    """
+    try:
+        it = os.scandir(root)
+    except PermissionError:
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from find_docked_sdfs(entry.path)
+            elif entry.name == 'docked_poses.sdf' and entry.is_file():
+                yield entry.path
+
+
+def extract_energies(sdf):
+    """Return {index: minimizedAffinity} for each docked item in an sdf.
+
+    The file is memory mapped and searched directly for each affinity tag,
+    so that the (much longer) coordinate blocks in between are skipped
+    over without being split into lines or decoded. The path to the sdf
+    should already have had any ~ expanded.
+    """
+    tag = b'> <minimizedAffinity>'
+    energies = {}
+    with open(sdf, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return energies
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            idx = 0
+            pos = mm.find(tag)
+            while pos >= 0:
+                start = mm.find(b'\n', pos) + 1
+                if not start or start == len(mm):
+                    break
+                # Tags only count at the start of a line
+                if pos and mm[pos - 1] != ord('\n'):
+                    pos = mm.find(tag, start)
+                    continue
+                end = mm.find(b'\n', start)
+                if end < 0:
+                    end = len(mm)
+                energies[idx] = float(mm[start:end])
+                idx += 1
+                pos = mm.find(tag, end)
+    return energies
+
+
+def rank_docked_poses(docked_sdf, rmsds):
+    """Rank the poses in a docked sdf by energy.
+
+    Arguments:
+        docked_sdf: sdf file containing docked poses with minimizedAffinity
+            fields
+        rmsds: array containing the RMSD of each docked pose with respect to
+            the crystal pose, indexed by pose number
+
+    Returns:
+        Array with columns (RMSD < 2, energy, RMSD), sorted by energy.
+    """
+    docked_energies = extract_energies(docked_sdf)
+    keys = np.fromiter(docked_energies.keys(), dtype=np.int64)
+    energies = np.fromiter(
+        (docked_energies[key] for key in keys), dtype=np.float64)
+    docked_rmsds = rmsds[keys]
+    order = np.argsort(energies, kind='stable')
+    combined = np.empty((len(keys), 3), dtype=np.float64)
+    combined[:, 1] = energies[order]
+    combined[:, 2] = docked_rmsds[order]
+    combined[:, 0] = combined[:, 2] < 2
+    return combined
 
 
 def parse_results(
@@ -27,73 +187,66 @@ def parse_results(
             rmsd_info
     Returns:
         Ranking object containing various statistics.
-    """
 
-    def extract_energies(sdf):
-        """Return {index: minimizedAffinity} for each docked item in an sdf."""
-        energies = {}
-        record_next = False
-        with open(Path(sdf).expanduser(), 'r') as f:
-            for line in f.readlines():
-                if line.startswith('> <minimizedAffinity>'):
-                    record_next = True
-                    continue
-                if record_next:
-                    energies[len(energies)] = float(line.strip())
-                    record_next = False
-        return energies
+    When given a directory containing more than one sdf file, the files are
+    parsed in a pool of worker processes. Workers are started with the
+    multiprocessing forkserver method, which imports the calling script's
+    main module; scripts calling parse_results must therefore do so from
+    within an if __name__ == '__main__': block.
+    """
 
     assert not (rmsd_info is None and rmsd_info_fname is None)
 
     if rmsd_info_fname is not None:
-        with open(Path(rmsd_info_fname).expanduser(), 'r') as f:
-            rmsd_info = yaml.load(f, Loader=yaml.FullLoader)
+        rmsd_info = load_rmsd_info(rmsd_info_fname)
+    rmsd_lookup = flatten_rmsd_info(rmsd_info)
 
     predictions_fname_or_sdf_root = Path(
         predictions_fname_or_sdf_root).expanduser()
     if predictions_fname_or_sdf_root.is_file():
         df = pd.read_csv(predictions_fname_or_sdf_root, sep=' ',
                          names=['y_true', '|', 'y_pred', 'rec', 'lig'])
-        y_true = list(df.y_true)
-        y_pred = list(df.y_pred)
-        recs = list(df.rec)
-        ligs = [Path(ligname).name.split('.')[0] for ligname in list(df.lig)]
-
-        pdbid_to_scores_and_rmsds = defaultdict(list)
-        top_ranked_rmsds = []
-        for i in range(len(df)):
-            pdbid = Path(recs[i]).name.split('.')[0]
-            rmsd_info_record = rmsd_info[pdbid]
-            if ligs[i].startswith('minimised'):
-                continue
-            rmsd = rmsd_info_record['docked_wrt_crystal'][int(
-                ligs[i].split('_')[-1])]
-            pdbid_to_scores_and_rmsds[recs[i]].append(
-                (y_true[i], y_pred[i], rmsd))
-
-        sorted_scores_and_rmsds_lst = []
-        for rec, lst in pdbid_to_scores_and_rmsds.items():
-            sorted_scores_and_rmsds = sorted(
-                lst, key=lambda x: x[1], reverse=True)
-            sorted_scores_and_rmsds = np.array(sorted_scores_and_rmsds)
-            sorted_scores_and_rmsds_lst.append(sorted_scores_and_rmsds)
-
-            top_ranked_rmsd = sorted_scores_and_rmsds[0][2]
-            top_ranked_rmsds.append(top_ranked_rmsd)
+        df['pdbid'] = file_stems(df.rec)
+        df['lig_name'] = file_stems(df.lig)
+        df = df[~df.lig_name.str.startswith('minimised')].copy()
+        df['lig_idx'] = df.lig_name.str.rsplit('_', n=1).str[-1].astype(int)
+        # Look up the RMSD array once per pdbid rather than once per row
+        lig_idxs = df.lig_idx.to_numpy()
+        rmsds = np.empty(len(df), dtype=np.float64)
+        for pdbid, rows in df.groupby('pdbid', sort=False).indices.items():
+            rmsds[rows] = rmsd_lookup[pdbid][lig_idxs[rows]]
+        df['rmsd'] = rmsds
+
+        # Sort once by receptor (in order of first appearance) then by
+        # descending score, and split the result into one array per receptor
+        rec_codes, _ = pd.factorize(df.rec)
+        scores_and_rmsds = df[['y_true', 'y_pred', 'rmsd']].to_numpy(
+            dtype=np.float64)
+        order = np.lexsort((-scores_and_rmsds[:, 1], rec_codes))
+        rec_boundaries = np.flatnonzero(np.diff(rec_codes[order])) + 1
+        sorted_scores_and_rmsds_lst = np.split(
+            scores_and_rmsds[order], rec_boundaries) if len(order) else []
     elif predictions_fname_or_sdf_root.is_dir():
-        sorted_scores_and_rmsds_lst = []
-        for docked_sdf in Path(predictions_fname_or_sdf_root).expanduser().glob(
-                '**/docked_poses.sdf'):
+        sdfs_and_rmsds = []
+        for docked_sdf in find_docked_sdfs(predictions_fname_or_sdf_root):
             try:
-                rmsds = rmsd_info[docked_sdf.parent.name]['docked_wrt_crystal']
+                rmsds = rmsd_lookup[os.path.basename(
+                    os.path.dirname(docked_sdf))]
             except KeyError:
                 continue
-            docked_energies = extract_energies(docked_sdf)
-            combined = np.array(sorted([(
-                0, docked_energies[key], rmsds[key]) for key in
-                docked_energies.keys()], key=lambda x: x[1]))
-            combined[:, 0] = combined[:, 2] < 2
-            sorted_scores_and_rmsds_lst.append(np.array(combined))
+            sdfs_and_rmsds.append((docked_sdf, rmsds))
+        # Parsing is bound by the GIL, so use processes rather than threads
+        # (unless there is only one file, where a pool would only add cost)
+        n_processes = min(mp.cpu_count(), len(sdfs_and_rmsds))
+        if n_processes > 1:
+            with mp.get_context('forkserver').Pool(
+                    processes=n_processes) as pool:
+                sorted_scores_and_rmsds_lst = pool.starmap(
+                    rank_docked_poses, sdfs_and_rmsds, chunksize=16)
+        else:
+            sorted_scores_and_rmsds_lst = [
+                rank_docked_poses(*sdf_and_rmsds)
+                for sdf_and_rmsds in sdfs_and_rmsds]
     else:
         raise FileNotFoundError(
             str(predictions_fname_or_sdf_root) + ' does not exist.')
@@ -166,17 +319,17 @@ if __name__ == '__main__':
                              'files')
 
     args = parser.parse_args()
-    rmsd_info = load_yaml(args.rmsd_info)
+    rmsd_info = load_rmsd_info(args.rmsd_info)
     label_to_ranking = {}
     predictions_txt_fnames = []
     if args.glob:
         for fname in args.results:
-            if not Path(fname).is_dir():
-                if Path(fname).name.startswith('predictions'):
+            path = Path(fname).expanduser()
+            if not path.is_dir():
+                if path.name.startswith('predictions'):
                     predictions_txt_fnames += [fname]
                 continue
-            preds = list(
-                Path(fname).expanduser().glob('**/predictions*.txt'))
+            preds = list(path.glob('**/predictions*.txt'))
             preds = prune_preds(preds)
             if len(preds):
                 predictions_txt_fnames += preds
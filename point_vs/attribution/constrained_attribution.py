@@ -47,7 +47,7 @@ def merge_structures(*fnames, output_fname='merged.pdb'):
     mkdir(output_fname.parent)
     pymol.cmd.save(str(Path(output_fname).expanduser()),
                    selection='({})'.format(
-                       ' or '.join([str(i) for i in range(len(fnames))])))
+                       ' or '.join(map(str, range(len(fnames))))))
     pymol.cmd.delete('all')
 
 
@@ -92,14 +92,17 @@ class PyMOLVisualizerWithBFactorColouring(PyMOLVisualizer):
             df.types.to_numpy(), max_feature_id + 1, compact).float()
         v = repeat(v, 'n d -> b n d', b=1)
 
-        model = model.eval().cuda()
-        score = float(to_numpy(
-            torch.sigmoid(model((p.cuda(), v.cuda(), m.cuda()))[0, ...])))
-        if not quiet:
-            print('Original score: {:.4}'.format(score))
-
-        model_labels = attribution_fn(
-            model, p.cuda(), v.cuda(), m.cuda(), bs=bs)
+        # Neither scoring nor the attribution functions backpropagate, so no
+        # autograd state needs to be recorded. The model should already be in
+        # eval mode on the GPU.
+        with torch.inference_mode():
+            score = float(to_numpy(
+                torch.sigmoid(model((p.cuda(), v.cuda(), m.cuda()))[0, ...])))
+            if not quiet:
+                print('Original score: {:.4}'.format(score))
+
+            model_labels = attribution_fn(
+                model, p.cuda(), v.cuda(), m.cuda(), bs=bs)
         df['attribution'] = model_labels
         df['any_interaction'] = df['hba'] | df['hbd'] | df['pistacking']
 
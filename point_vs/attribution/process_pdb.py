@@ -1,5 +1,9 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
+from openbabel import openbabel
 from pandas import DataFrame
 from plip.basic import config
 from plip.basic.supplemental import create_folder_if_not_exists, start_pymol
@@ -12,53 +16,110 @@ from point_vs.attribution.plip_subclasses import \
     PyMOLVisualizerWithBFactorColouring, VisualizerDataWithMolecularInfo
 from point_vs.utils import mkdir
 
+_SDF_CONVERSION = None
+
+
+def write_sdf(ob_mol, fname):
+    """Write an openbabel OBMol object to an sdf file.
+
+    A single OBConversion object set up for sdf output is shared between
+    calls, so that the output format is only looked up once per process.
+    """
+    global _SDF_CONVERSION
+    if _SDF_CONVERSION is None:
+        _SDF_CONVERSION = openbabel.OBConversion()
+        _SDF_CONVERSION.SetOutFormat('sdf')
+    _SDF_CONVERSION.WriteFile(ob_mol, str(fname))
+    _SDF_CONVERSION.CloseOutFile()
+
+
+def load_characterised_complex(pdbfile, outpath):
+    """Load a PDB file into a PLIP PDBComplex and characterise every ligand.
+
+    Characterisation (hydrogen perception, ring detection and interaction
+    detection) is expensive, so this is done once per call to score_pdb or
+    score_and_colour_pdb and shared between all of the binding sites.
+    """
+    mol = PDBComplex()
+    mol.output_path = str(Path(outpath).expanduser())
+    mol.load_pdb(str(Path(pdbfile).expanduser()), as_string=False)
+
+    for ligand in mol.ligands:
+        mol.characterize_complex(ligand)
+    return mol
+
+
+def load_pymol_session(plcomplex):
+    """Start PyMOL and load the structure containing plcomplex.
+
+    The structure is renamed to its PDB ID and everything is hidden, ready for
+    the site-specific visualizations in visualize_in_pymol.
+    """
+    start_pymol(run=True, options='-pcq',
+                quiet=not config.VERBOSE and not config.SILENT)
+    PyMOLVisualizerWithBFactorColouring(plcomplex).set_initial_representations()
+
+    cmd.load(plcomplex.sourcefile)
+    current_name = cmd.get_object_list(selection='(all)')[0]
+
+    logger.debug(
+        f'setting current_name to {current_name} and PDB-ID to '
+        f'{plcomplex.pdbid}')
+    cmd.set_name(current_name, plcomplex.pdbid)
+    cmd.hide('everything', 'all')
+
 
 def visualize_in_pymol(
         model, attribution_fn, plcomplex, output_dir, model_args,
-        only_process=None):
+        only_process=None, session_already_loaded=False):
     """Visualizes the given Protein-Ligand complex at one site in PyMOL.
 
     This function is based on the origina plip.visualization.vizualise_in_pymol
     function, with the added functinoality which uses a machine learning model
     to colour the receptor atoms by
+
+    If session_already_loaded is True, the structure is assumed to have been
+    loaded by load_pymol_session (with no site-specific changes since), and
+    PyMOL is not restarted.
     """
 
     vis = PyMOLVisualizerWithBFactorColouring(plcomplex)
+    model = model.eval().cuda()
 
     #####################
     # Set everything up #
     #####################
 
+    # PLIP global configuration used below
+    peptides = config.PEPTIDES
+    intra = config.INTRA
+    dnareceptor = config.DNARECEPTOR
+    pics = config.PICS
+    pymol_session = config.PYMOL
+    plip_outpath = config.OUTPATH
+
     pdbid = plcomplex.pdbid
     lig_members = plcomplex.lig_members
     chain = plcomplex.chain
-    if config.PEPTIDES:
+    if peptides:
         vis.ligname = 'PeptideChain%s' % plcomplex.chain
-    if config.INTRA is not None:
+    if intra is not None:
         vis.ligname = 'Intra%s' % plcomplex.chain
 
     ligname = vis.ligname
     hetid = plcomplex.hetid
 
     metal_ids = plcomplex.metal_ids
-    metal_ids_str = '+'.join([str(i) for i in metal_ids])
+    metal_ids_str = '+'.join(map(str, metal_ids))
 
     ########################
     # Basic visualizations #
     ########################
 
-    start_pymol(run=True, options='-pcq',
-                quiet=not config.VERBOSE and not config.SILENT)
-    vis.set_initial_representations()
+    if not session_already_loaded:
+        load_pymol_session(plcomplex)
 
-    cmd.load(plcomplex.sourcefile)
-    current_name = cmd.get_object_list(selection='(all)')[0]
-
-    logger.debug(
-        f'setting current_name to {current_name} and PDB-ID to {pdbid}')
-    cmd.set_name(current_name, pdbid)
-    cmd.hide('everything', 'all')
-    if config.PEPTIDES:
+    if peptides:
         cmd.select(ligname, 'chain %s and not resn HOH' % plcomplex.chain)
     else:
         cmd.select(ligname, 'resn %s and chain %s and resi %s*' % (
@@ -73,12 +134,13 @@ def visualize_in_pymol(
         vis.select_by_ids(ligname, metal_ids, selection_exists=True)
         cmd.show('spheres', 'id %s and %s' % (metal_ids_str, pdbid))
 
-    # Additionally, select all members of composite ligands
+    # Additionally, select all members of composite ligands (in a single
+    # selection expression, rather than one PyMOL call per member)
     if len(lig_members) > 1:
-        for member in lig_members:
-            resid, chain, resnr = member[0], member[1], str(member[2])
-            cmd.select(ligname, '%s or (resn %s and chain %s and resi %s)' % (
-                ligname, resid, chain, resnr))
+        member_selections = [
+            '(resn %s and chain %s and resi %s)' % (
+                member[0], member[1], member[2]) for member in lig_members]
+        cmd.select(ligname, ' or '.join([ligname] + member_selections))
 
     cmd.show('sticks', ligname)
     cmd.color('myblue')
@@ -120,59 +182,61 @@ def visualize_in_pymol(
     vis.selections_group()
     vis.additional_cleanup()
 
-    if config.DNARECEPTOR:
+    if dnareceptor:
         # Rename Cartoon selection to Line selection and change repr.
         cmd.set_name('%sCartoon' % plcomplex.pdbid, '%sLines' % plcomplex.pdbid)
         cmd.hide('cartoon', '%sLines' % plcomplex.pdbid)
         cmd.show('lines', '%sLines' % plcomplex.pdbid)
 
-    if config.PEPTIDES:
+    if peptides:
         filename = "%s_PeptideChain%s" % (pdbid.upper(), plcomplex.chain)
-        if config.PYMOL:
-            vis.save_session(config.OUTPATH, override=filename)
-    elif config.INTRA is not None:
+        if pymol_session:
+            vis.save_session(plip_outpath, override=filename)
+    elif intra is not None:
         filename = "%s_IntraChain%s" % (pdbid.upper(), plcomplex.chain)
-        if config.PYMOL:
-            vis.save_session(config.OUTPATH, override=filename)
+        if pymol_session:
+            vis.save_session(plip_outpath, override=filename)
     else:
         filename = '%s_%s' % (
             pdbid.upper(),
             "_".join([hetid, plcomplex.chain, plcomplex.position]))
         vis.save_session(plcomplex.mol.output_path, override=filename)
-    if config.PICS:
-        vis.save_picture(config.OUTPATH, filename)
+    if pics:
+        vis.save_picture(plip_outpath, filename)
 
     return score, df
 
 
 def score_pdb(
         model, attribution_fn, pdbfile, outpath, model_args,
-        only_process=None, quiet=False, save_ligand_sdf=False):
-    mol = PDBComplex()
+        only_process=None, quiet=False, save_ligand_sdf=False, n_workers=1):
+    """Score the atoms around each ligand binding site in a PDB file.
+
+    Sites are scored by up to n_workers threads at once. Each concurrent site
+    needs its own inputs and activations on the GPU, so peak GPU memory grows
+    with n_workers; the default of 1 scores sites one after the other.
+    """
     outpath = str(Path(outpath).expanduser())
     pdbfile = str(Path(pdbfile).expanduser())
-    mol.output_path = outpath
-
-    mol.load_pdb(pdbfile, as_string=False)
-
-    for ligand in mol.ligands:
-        mol.characterize_complex(ligand)
+    mol = load_characterised_complex(pdbfile, outpath)
 
     mkdir(outpath)
 
-    complexes = [VisualizerDataWithMolecularInfo(mol, site) for site in sorted(
-        mol.interaction_sets)
-                 if not len(mol.interaction_sets[site].interacting_res) == 0]
+    sites = [site for site in sorted(mol.interaction_sets)
+             if not len(mol.interaction_sets[site].interacting_res) == 0]
 
     if save_ligand_sdf:
-        ligand_outpath = str(Path(outpath, 'crystal_ligand.sdf'))
-        complexes[0].ligand.molecule.write(
-            format='sdf', filename=ligand_outpath, overwrite=True)
+        ligand_outpath = os.path.join(outpath, 'crystal_ligand.sdf')
+        write_sdf(VisualizerDataWithMolecularInfo(
+            mol, sites[0]).ligand.molecule.OBMol, ligand_outpath)
         print('Saved ligand as sdf to', ligand_outpath)
 
     def score_atoms(
-            model, attribution_fn, plcomplex, model_args, only_process=None):
+            model, attribution_fn, site, model_args, only_process=None):
 
+        # The VisualizerData is only constructed when the site is scored, so
+        # that at most n_workers of them are held in memory at once
+        plcomplex = VisualizerDataWithMolecularInfo(mol, site)
         vis = PyMOLVisualizerWithBFactorColouring(plcomplex)
 
         if config.PEPTIDES:
@@ -186,24 +250,24 @@ def score_pdb(
             quiet=quiet)
         return df
 
-    dfs = [score_atoms(
-        model, attribution_fn=attribution_fn, plcomplex=plcomplex,
-        model_args=model_args, only_process=only_process)
-        for plcomplex in complexes]
-    dfs = [df for df in dfs if df is not None]
-    return dfs
+    model = model.eval().cuda()
+    score_fn = partial(
+        score_atoms, model, attribution_fn, model_args=model_args,
+        only_process=only_process)
+
+    if n_workers == 1:
+        dfs = [score_fn(site) for site in sites]
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            dfs = list(executor.map(score_fn, sites))
+    return [df for df in dfs if df is not None]
 
 
 def score_and_colour_pdb(
         model, attribution_fn, pdbfile, outpath, model_args, only_process=None):
-    mol = PDBComplex()
     outpath = str(Path(outpath).expanduser())
     pdbfile = str(Path(pdbfile).expanduser())
-    mol.output_path = outpath
-    mol.load_pdb(pdbfile, as_string=False)
-
-    for ligand in mol.ligands:
-        mol.characterize_complex(ligand)
+    mol = load_characterised_complex(pdbfile, outpath)
 
     create_folder_if_not_exists(outpath)
 
@@ -211,16 +275,24 @@ def score_and_colour_pdb(
         mol.interaction_sets)
                  if not len(mol.interaction_sets[site].interacting_res) == 0]
 
-    dfs = {
-        plcomplex.uid: visualize_in_pymol(
+    # Every site shares the same structure, so it is only loaded into PyMOL
+    # once; the resulting state is restored before visualizing each site
+    initial_session = None
+    dfs = {}
+    for plcomplex in complexes:
+        if initial_session is None:
+            load_pymol_session(plcomplex)
+            initial_session = cmd.get_session()
+        else:
+            cmd.set_session(initial_session)
+        dfs[plcomplex.uid] = visualize_in_pymol(
             model,
             attribution_fn=attribution_fn,
             output_dir=outpath,
             plcomplex=plcomplex,
             model_args=model_args,
-            only_process=only_process)
-        for plcomplex in complexes
-    }
+            only_process=only_process,
+            session_already_loaded=True)
     dfs = {lig_id: (score, df) for lig_id, (score, df)
            in dfs.items() if df is not None}
     return dfs
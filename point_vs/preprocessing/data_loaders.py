@@ -108,7 +108,7 @@ def multiple_source_dataset(
     multi_source_dataset.class_sample_count = class_sample_count
     multi_source_dataset.labels = labels
     multi_source_dataset.filenames = filenames
-    multi_source_dataset.base_path = ', '.join([str(bp) for bp in base_paths])
+    multi_source_dataset.base_path = ', '.join(map(str, base_paths))
     multi_source_dataset.feature_dim = datasets[0].feature_dim
     return multi_source_dataset
 
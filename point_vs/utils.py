@@ -310,7 +310,7 @@ def print_with_overwrite(*s, spacer=' '):
         spacer: whitespace character to use between words on each line
     """
     s = '\n'.join(
-        [spacer.join([str(word) for word in substring]) for substring in s])
+        [spacer.join(map(str, substring)) for substring in s])
     erase = '\x1b[2K'
     up_one = '\x1b[1A'
     lines = s.split('\n')
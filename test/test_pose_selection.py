@@ -0,0 +1,214 @@
+import os
+import pickle
+import random
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from point_vs.analysis import pose_selection
+from point_vs.analysis.pose_selection import extract_energies, \
+    find_docked_sdfs, flatten_rmsd_info, load_rmsd_info, parse_results, \
+    rank_docked_poses
+
+POSE = 'mol\n  0.0 0.0 0.0 C\nM  END\n> <minimizedAffinity>\n{}\n\n$$$$\n'
+
+
+def extract_energies_by_line(sdf):
+    """Line-by-line parser which extract_energies replaced."""
+    energies = {}
+    record_next = False
+    with open(sdf, 'r') as f:
+        for line in f.readlines():
+            if line.startswith('> <minimizedAffinity>'):
+                record_next = True
+                continue
+            if record_next:
+                energies[len(energies)] = float(line.strip())
+                record_next = False
+    return energies
+
+
+def parse_text_results_by_row(predictions_fname, rmsd_info):
+    """Row-by-row text results parser which parse_results replaced."""
+    df = pd.read_csv(predictions_fname, sep=' ',
+                     names=['y_true', '|', 'y_pred', 'rec', 'lig'])
+    y_true = list(df.y_true)
+    y_pred = list(df.y_pred)
+    recs = list(df.rec)
+    ligs = [Path(ligname).name.split('.')[0] for ligname in list(df.lig)]
+
+    pdbid_to_scores_and_rmsds = defaultdict(list)
+    for i in range(len(df)):
+        pdbid = Path(recs[i]).name.split('.')[0]
+        rmsd_info_record = rmsd_info[pdbid]
+        if ligs[i].startswith('minimised'):
+            continue
+        rmsd = rmsd_info_record['docked_wrt_crystal'][int(
+            ligs[i].split('_')[-1])]
+        pdbid_to_scores_and_rmsds[recs[i]].append(
+            (y_true[i], y_pred[i], rmsd))
+
+    return [np.array(sorted(lst, key=lambda x: x[1], reverse=True))
+            for lst in pdbid_to_scores_and_rmsds.values()]
+
+
+def rank_docked_poses_by_sort(docked_sdf, rmsds):
+    """Tuple-sorting docked pose ranking which rank_docked_poses replaced."""
+    docked_energies = extract_energies_by_line(docked_sdf)
+    combined = np.array(sorted([(
+        0, docked_energies[key], rmsds[key]) for key in
+        docked_energies.keys()], key=lambda x: x[1]))
+    combined[:, 0] = combined[:, 2] < 2
+    return combined
+
+
+def make_rmsd_info(n_receptors, max_poses, rng):
+    return {'{}abc'.format(i): {'docked_wrt_crystal': {
+        j: round(rng.random() * 4, 3)
+        for j in range(rng.randint(1, max_poses))}}
+        for i in range(n_receptors)}
+
+
+def test_parse_results_text_matches_row_parser(tmp_path):
+    rng = random.Random(2)
+    rmsd_info = make_rmsd_info(12, 10, rng)
+    lines = []
+    for pdbid, record in rmsd_info.items():
+        for idx in record['docked_wrt_crystal']:
+            # Coarse scores so that there are plenty of ties
+            lines.append('{0} | {1} /data/receptors/{2}.parquet '
+                         '/data/ligands/{2}_docked_{3}.parquet'.format(
+                             rng.randint(0, 1), rng.randint(0, 4) / 4, pdbid,
+                             idx))
+        lines.append('0 | 0.99 /data/receptors/{0}.parquet '
+                     '/data/ligands/minimised_{0}.parquet'.format(pdbid))
+    rng.shuffle(lines)
+    predictions_fname = tmp_path / 'predictions.txt'
+    predictions_fname.write_text('\n'.join(lines) + '\n')
+
+    expected = parse_text_results_by_row(predictions_fname, rmsd_info)
+    result = parse_results(
+        predictions_fname, rmsd_info=rmsd_info).sorted_scores_and_rmsds
+    assert len(result) == len(expected) == len(rmsd_info)
+    for arr, expected_arr in zip(result, expected):
+        np.testing.assert_array_equal(arr, expected_arr)
+
+
+def test_rank_docked_poses_matches_tuple_sort(tmp_path):
+    rng = random.Random(2)
+    rmsd_info = make_rmsd_info(5, 20, rng)
+    rmsd_lookup = flatten_rmsd_info(rmsd_info)
+    for pdbid, record in rmsd_info.items():
+        docked_sdf = tmp_path / pdbid / 'docked_poses.sdf'
+        docked_sdf.parent.mkdir()
+        docked_sdf.write_text(''.join(
+            POSE.format(rng.randint(-20, 0) / 2)
+            for _ in record['docked_wrt_crystal']))
+        np.testing.assert_array_equal(
+            rank_docked_poses(docked_sdf, rmsd_lookup[pdbid]),
+            rank_docked_poses_by_sort(
+                docked_sdf, record['docked_wrt_crystal']))
+
+    # A single sdf is ranked without starting a pool of worker processes
+    sdf_root = tmp_path / 'single'
+    (sdf_root / '0abc').mkdir(parents=True)
+    os.rename(tmp_path / '0abc' / 'docked_poses.sdf',
+              sdf_root / '0abc' / 'docked_poses.sdf')
+    result = parse_results(
+        sdf_root, rmsd_info=rmsd_info).sorted_scores_and_rmsds
+    assert len(result) == 1
+    np.testing.assert_array_equal(result[0], rank_docked_poses_by_sort(
+        sdf_root / '0abc' / 'docked_poses.sdf',
+        rmsd_info['0abc']['docked_wrt_crystal']))
+
+
+@pytest.mark.parametrize('contents', [
+    ''.join(POSE.format(e) for e in (-7.5, -6.25, 0.1)),
+    ''.join(POSE.format(e) for e in (-7.5, -6.25)).replace('\n', '\r\n'),
+    POSE.format(-3.0) + '> <minimizedAffinity>\n-2.5',
+    POSE.format(-3.0) + '> <minimizedAffinity>\n',
+    POSE.format(-3.0) + '> <minimizedAffinity>',
+    'mol\n  > <minimizedAffinity>\n1.0\n' + POSE.format(-4.0),
+    '',
+], ids=['lf', 'crlf', 'no_trailing_newline', 'tag_on_last_line',
+        'tag_at_eof', 'tag_not_at_line_start', 'empty'])
+def test_extract_energies_matches_line_parser(tmp_path, contents):
+    sdf = tmp_path / 'docked_poses.sdf'
+    with open(sdf, 'w', newline='') as f:
+        f.write(contents)
+    assert extract_energies(sdf) == extract_energies_by_line(sdf)
+
+
+def test_flatten_rmsd_info_fills_missing_indices_with_nan():
+    rmsd_lookup = flatten_rmsd_info({
+        'dense': {'docked_wrt_crystal': {0: 1.5, 1: 0.5}},
+        'sparse': {'docked_wrt_crystal': {3: 2.0, 0: 1.0}},
+        'empty': {'docked_wrt_crystal': {}},
+    })
+    np.testing.assert_array_equal(rmsd_lookup['dense'], [1.5, 0.5])
+    np.testing.assert_array_equal(
+        rmsd_lookup['sparse'], [1.0, np.nan, np.nan, 2.0])
+    assert len(rmsd_lookup['empty']) == 0
+
+
+def test_load_rmsd_info_uses_and_repairs_cache(tmp_path):
+    rmsd_info = {'1abc': {'docked_wrt_crystal': {0: 1.5, 1: 0.5}}}
+    yaml_fname = tmp_path / 'rmsd_info.yaml'
+    with open(yaml_fname, 'w') as f:
+        yaml.dump(rmsd_info, f)
+    unrelated_pkl = tmp_path / 'rmsd_info.pkl'
+    unrelated_pkl.write_bytes(b'not a cache')
+
+    assert load_rmsd_info(yaml_fname) == rmsd_info
+    cache_fname = tmp_path / 'rmsd_info.yaml.pkl'
+    with open(cache_fname, 'rb') as f:
+        assert pickle.load(f) == rmsd_info
+    assert unrelated_pkl.read_bytes() == b'not a cache'
+    assert sorted(os.listdir(tmp_path)) == [
+        'rmsd_info.pkl', 'rmsd_info.yaml', 'rmsd_info.yaml.pkl']
+
+    # A truncated cache should be ignored and then rewritten
+    cache_fname.write_bytes(cache_fname.read_bytes()[:10])
+    assert load_rmsd_info(yaml_fname) == rmsd_info
+    with open(cache_fname, 'rb') as f:
+        assert pickle.load(f) == rmsd_info
+
+
+def test_load_rmsd_info_accepts_python_tags(tmp_path):
+    # RMSDs computed with numpy are dumped with python/object tags, which
+    # need the full yaml.Loader (as used by point_vs.utils.load_yaml)
+    rmsd_info = {'1abc': {'docked_wrt_crystal': {
+        0: np.float64(1.5), 1: np.float64(0.5)}}}
+    yaml_fname = tmp_path / 'rmsd_info.yaml'
+    with open(yaml_fname, 'w') as f:
+        yaml.dump(rmsd_info, f)
+    assert 'python/object' in yaml_fname.read_text()
+
+    assert load_rmsd_info(yaml_fname) == rmsd_info
+    # Second call is served from the pickled cache
+    assert load_rmsd_info(yaml_fname) == rmsd_info
+
+
+def test_find_docked_sdfs_skips_unreadable_directories(tmp_path, monkeypatch):
+    for subdir in ('a/1abc', 'a/2abc', 'b/3abc', 'b/3abc/nested'):
+        (tmp_path / subdir).mkdir(parents=True)
+        (tmp_path / subdir / 'docked_poses.sdf').touch()
+    (tmp_path / 'a' / 'other.sdf').touch()
+
+    scandir = os.scandir
+    unreadable = str(tmp_path / 'b')
+
+    def scandir_without_permission(path):
+        if str(path) == unreadable:
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(pose_selection.os, 'scandir',
+                        scandir_without_permission)
+    assert sorted(find_docked_sdfs(tmp_path)) == [
+        str(tmp_path / 'a/1abc/docked_poses.sdf'),
+        str(tmp_path / 'a/2abc/docked_poses.sdf')]